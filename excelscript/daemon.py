@@ -0,0 +1,318 @@
+import argparse
+import hmac
+import itertools
+import json
+import logging
+import pathlib
+import queue
+import sys
+import threading
+import urllib.error
+import urllib.request
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import yaml
+from openpyxl.utils import exceptions
+
+from .data import DataHolder, read_config, load_sheets
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8765
+# 客户端可以覆盖的sheet设置
+SHEET_KEYS = ('title_row1', 'title_row2', 'key_cell', 'output')
+
+
+def service_config(config):
+    cfg = config.get('服务') or {}
+    return {
+        'host': cfg.get('地址', DEFAULT_HOST),
+        'port': int(cfg.get('端口', DEFAULT_PORT)),
+        'workers': int(cfg.get('线程', 2)),
+        'cache': int(cfg.get('缓存', 4)),
+        'token': str(cfg.get('令牌') or ''),
+    }
+
+
+class WorkbookCache:
+    """最近读取的excel(所有sheet的SheetStore), 按文件路径和修改时间缓存, 超过容量时淘汰最久未使用的
+
+    分组单元格的查找依赖任务的config, 每个任务重新创建DataHolder
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, file):
+        path = pathlib.Path(file).resolve()
+        key = (str(path), path.stat().st_mtime_ns)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                # 同一文件的旧版本不再需要
+                for k in [k for k in self.entries if k[0] == key[0]]:
+                    del self.entries[k]
+                entry = self.entries[key] = {'sheets': None, 'lock': threading.Lock()}
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.capacity:
+                k, _ = self.entries.popitem(last=False)
+                logger.info(f'workbook缓存已淘汰:{k[0]}')
+        return entry
+
+
+class Job:
+    def __init__(self, job_id, file, sheets, config):
+        self.id = job_id
+        self.file = file
+        self.sheets = sheets
+        self.config = config
+        self.events = []
+        self.done = False
+        self.cond = threading.Condition()
+
+    def emit(self, event, done=False):
+        with self.cond:
+            self.events.append(event)
+            self.done = self.done or done
+            self.cond.notify_all()
+
+    def follow(self):
+        i = 0
+        while True:
+            with self.cond:
+                while i >= len(self.events) and not self.done:
+                    self.cond.wait()
+                events = self.events[i:]
+                done = self.done
+            i += len(events)
+            yield from events
+            if done and i >= len(self.events):
+                return
+
+
+class SplitDaemon:
+    def __init__(self, workers=2, cache=4):
+        self.cache = WorkbookCache(cache)
+        self.queue = queue.Queue()
+        self.jobs = {}
+        self.jobs_lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.threads = [threading.Thread(target=self.work, daemon=True) for _ in range(workers)]
+        for t in self.threads:
+            t.start()
+
+    def submit(self, file, sheets, config=None):
+        with self.jobs_lock:
+            job = Job(str(next(self.ids)), file, sheets or {}, config or {})
+            self.jobs[job.id] = job
+            # 只保留最近的任务记录
+            for k in [k for k, j in self.jobs.items() if j.done][:-100]:
+                del self.jobs[k]
+        job.emit({'type': 'progress', 'msg': f'排队中({self.queue.qsize()})..'})
+        self.queue.put(job)
+        logger.info(f'新任务{job.id}:{file}')
+        return job
+
+    def work(self):
+        while True:
+            job = self.queue.get()
+            try:
+                result = self.run(job)
+            except exceptions.InvalidFileException:
+                job.emit({'type': 'error', 'msg': '不支持的文件类型'}, done=True)
+            except Exception as e:
+                logger.exception(f'任务{job.id}失败')
+                job.emit({'type': 'error', 'msg': str(e)}, done=True)
+            else:
+                job.emit({'type': 'result', 'result': sorted(result)}, done=True)
+            finally:
+                self.queue.task_done()
+
+    def run(self, job):
+        def progress_callback(msg):
+            job.emit({'type': 'progress', 'msg': msg})
+
+        config = read_config()
+        config.update(job.config)
+        entry = self.cache.get(job.file)
+        # 只有读取excel需要加锁, SheetStore读取后不再修改, 可以同时被多个任务使用
+        with entry['lock']:
+            if entry['sheets'] is None:
+                progress_callback('读取excel..')
+                entry['sheets'] = load_sheets(job.file)
+            else:
+                logger.info(f'使用缓存的excel:{job.file}')
+            sheets = entry['sheets']
+        holder = DataHolder(job.file, sheets, config)
+        if not job.sheets:
+            for detail in holder.sheet_detail.values():
+                detail['output'] = True
+        for title, detail in job.sheets.items():
+            if title not in holder.sheet_detail:
+                raise KeyError(f'sheet不存在:{title}')
+            holder.sheet_detail[title].update({k: detail[k] for k in SHEET_KEYS if k in detail})
+        return holder.gen(progress_callback)
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    daemon = None
+    token = ''
+
+    def send_json(self, code, obj):
+        body = json.dumps(obj, ensure_ascii=False).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def check_token(self):
+        # 配置了令牌时, 请求必须带上相同的令牌
+        if self.token and not hmac.compare_digest(self.headers.get('X-Token', ''), self.token):
+            self.send_json(403, {'msg': '令牌错误'})
+            return False
+        return True
+
+    def do_POST(self):
+        if self.path != '/jobs':
+            self.send_json(404, {'msg': '未知路径'})
+            return
+        if not self.check_token():
+            return
+        # 网页可以不经过CORS预检发送text/plain等请求, 只接受json
+        if self.headers.get_content_type() != 'application/json':
+            self.send_json(415, {'msg': '只支持application/json'})
+            return
+        try:
+            req = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            config = req.get('config') or {}
+            if '输出' in config:
+                raise ValueError('不允许修改输出目录')
+            # 导出的名字用作文件名, 不能是路径(包括windows的盘符), 不能指向输出目录以外
+            for name in config.get('导出') or {}:
+                if not isinstance(name, str) or not name or any(c in name for c in ('/', '\\', ':', '..')):
+                    raise ValueError(f'导出名称不合法:{name}')
+            job = self.daemon.submit(req['file'], req.get('sheets'), config)
+        except (ValueError, KeyError, TypeError) as e:
+            self.send_json(400, {'msg': f'任务参数错误:{e}'})
+            return
+        self.send_json(200, {'id': job.id})
+
+    def do_GET(self):
+        if not self.check_token():
+            return
+        parts = self.path.strip('/').split('/')
+        job = self.daemon.jobs.get(parts[1]) if len(parts) == 2 and parts[0] == 'jobs' else None
+        if job is None:
+            self.send_json(404, {'msg': '任务不存在'})
+            return
+        # 每行一个事件, 任务结束后关闭连接
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson; charset=utf-8')
+        self.end_headers()
+        for event in job.follow():
+            self.wfile.write(json.dumps(event, ensure_ascii=False).encode('utf-8') + b'\n')
+            self.wfile.flush()
+
+    def log_message(self, format, *args):
+        logger.debug(format % args)
+
+
+def make_server(config):
+    cfg = service_config(config)
+    handler = type('Handler', (RequestHandler,), {'daemon': SplitDaemon(cfg['workers'], cfg['cache']),
+                                                 'token': cfg['token']})
+    return ThreadingHTTPServer((cfg['host'], cfg['port']), handler)
+
+
+def serve(config):
+    server = make_server(config)
+    logger.info(f'拆表服务已启动:{server.server_address[0]}:{server.server_address[1]}')
+    server.serve_forever()
+
+
+def submit(config, file, sheets=None, job_config=None, progress_callback=None):
+    """提交任务并等待结束, 返回未归类的分组
+
+    只有连接不上服务(任务还没有提交)时抛出URLError, 任务提交后的错误都是RuntimeError
+    """
+    cfg = service_config(config)
+    url = f"http://{cfg['host']}:{cfg['port']}/jobs"
+    data = json.dumps({'file': str(file), 'sheets': sheets, 'config': job_config}, ensure_ascii=False)
+    headers = {'Content-Type': 'application/json', 'X-Token': cfg['token']}
+    req = urllib.request.Request(url, data=data.encode('utf-8'), headers=headers)
+    # 服务在本机, 不经过http_proxy等代理, 令牌也不会发给代理
+    opener = urllib.request.build_opener(urllib.request.ProxyHandler({}))
+    try:
+        with opener.open(req) as resp:
+            job_id = json.loads(resp.read())['id']
+    except urllib.error.HTTPError as e:
+        raise RuntimeError(error_message(e))
+
+    req = urllib.request.Request(f'{url}/{job_id}', headers={'X-Token': cfg['token']})
+    try:
+        with opener.open(req) as resp:
+            for line in resp:
+                event = json.loads(line)
+                if event['type'] == 'progress':
+                    if progress_callback:
+                        progress_callback(event['msg'])
+                elif event['type'] == 'error':
+                    raise RuntimeError(event['msg'])
+                else:
+                    return set(event['result'])
+    except urllib.error.HTTPError as e:
+        raise RuntimeError(error_message(e))
+    except OSError as e:
+        # 任务已经在服务中运行, 不能再本地导出
+        raise RuntimeError(f'任务{job_id}中断:{e}')
+    raise RuntimeError(f'任务{job_id}中断')
+
+
+def error_message(e):
+    try:
+        return json.loads(e.read()).get('msg', str(e))
+    except ValueError:
+        return str(e)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m excelscript.daemon', description='本地拆表服务')
+    sub = parser.add_subparsers(dest='command', required=True)
+    sub.add_parser('serve', help='启动服务')
+    p = sub.add_parser('submit', help='提交拆表任务')
+    p.add_argument('file')
+    p.add_argument('-s', '--sheet', action='append', default=[], help='需要导出的sheet, 默认全部')
+    p.add_argument('-c', '--config', help='覆盖config.yml的yml文件, 例如不同的导出配置')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', encoding='utf-8',
+                        level=logging.INFO)
+    config = read_config()
+    if args.command == 'serve':
+        serve(config)
+        return 0
+
+    job_config = None
+    if args.config:
+        with open(args.config, encoding='utf-8') as f:
+            job_config = yaml.load(f, Loader=yaml.FullLoader)
+    sheets = {s: {'output': True} for s in args.sheet}
+    try:
+        result = submit(config, pathlib.Path(args.file).resolve(), sheets, job_config, print)
+    except RuntimeError as e:
+        print(f'导出excel失败: {e}')
+        return 1
+    if result:
+        print(f"导出excel成功，以下分组未归类: {', '.join(sorted(result))}")
+    else:
+        print('导出excel成功')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,15 +1,28 @@
+import glob
 import logging
 import pathlib
+import re
+import tempfile
 from copy import copy
 
 import openpyxl
 import yaml
-from openpyxl.styles import Font, Color, Alignment
+from openpyxl.utils import get_column_letter, column_index_from_string
+from openpyxl.utils.cell import coordinate_from_string
 from openpyxl.workbook import Workbook
 from openpyxl.worksheet.cell_range import CellRange
 
+from .store import SheetStore
+
 logger = logging.getLogger(__name__)
 
+# excel每个sheet最多1048576行
+EXCEL_MAX_ROW = 1048576
+# 估算大小时每个单元格xml(<c r=".." s=".." t=".."><v></v></c>)的字节数
+CELL_SIZE = 30
+# 表头最多读取到BZ列
+TITLE_MAX_COLUMN = 78
+
 
 def read_config():
     with open(pathlib.Path(__file__).parent / 'config.yml', encoding='utf-8') as f:
@@ -17,58 +30,98 @@ def read_config():
         return config
 
 
+def load_sheets(file):
+    """流式读取所有sheet, 读取完成后关闭workbook, 不保留openpyxl的单元格"""
+    wb = openpyxl.load_workbook(file, read_only=True, rich_text=True, data_only=True)
+    try:
+        return [SheetStore.load(ws) for ws in wb]
+    finally:
+        wb.close()
+
+
 class DataHolder:
-    def __init__(self, file, wb, config):
+    def __init__(self, file, sheets, config):
         self.file = file
-        self.wb = wb
+        self.sheets = sheets
         self.config = config
         self.sheet_detail = {}
-        for ws in wb:
+        for ws in sheets:
             self.sheet_detail[ws.title] = {}
             self.sheet_detail[ws.title]['title_row1'] = 1
             self.sheet_detail[ws.title]['output'] = False
-            cell_rc = self.search_keyword(ws['A1:BZ10'], self.config['分组'])
+            cell_rc = ws.search(self.config['分组'], 1, 10, TITLE_MAX_COLUMN)
             self.sheet_detail[ws.title]['title_column2'] = 1
             if cell_rc:
                 self.sheet_detail[ws.title]['title_row2'] = cell_rc[1]
-                cell = ws.cell(row=cell_rc[1], column=cell_rc[0])
-                self.sheet_detail[ws.title]['key_cell'] = cell.coordinate
-                logger.debug(f'sheet({ws.title})的分组单元格为{cell.coordinate}, {cell.value}')
+                coordinate = f'{get_column_letter(cell_rc[0])}{cell_rc[1]}'
+                self.sheet_detail[ws.title]['key_cell'] = coordinate
+                logger.debug(f'sheet({ws.title})的分组单元格为{coordinate}, {ws.value(cell_rc[1], cell_rc[0])}')
             else:
                 self.sheet_detail[ws.title]['title_row2'] = 1
-                cell = ws.cell(row=1, column=1)
-                self.sheet_detail[ws.title]['key_cell'] = cell.coordinate
-                logger.debug(f'sheet({ws.title})的分组单元格未找到,使用默认值 {cell.coordinate}, {cell.value}')
+                self.sheet_detail[ws.title]['key_cell'] = 'A1'
+                logger.debug(f'sheet({ws.title})的分组单元格未找到,使用默认值 A1, {ws.value(1, 1)}')
             # 方便测试
             # self.sheet_detail[ws.title]['title_row2'] = 3
 
     @staticmethod
     def create(file):
-        wb = openpyxl.load_workbook(file, rich_text=True, data_only=True)
+        sheets = load_sheets(file)
         config = read_config()
-        return DataHolder(file, wb, config)
-
-    def search_keyword(self, area, keyword):
-        for row in area:
-            for cell in row:
-                if type(cell.value) == str and keyword == cell.value.strip():
-                    return cell.column, cell.row
+        return DataHolder(file, sheets, config)
 
     def gen(self, progress_callback):
         path = pathlib.Path(self.config['输出'])
         path.mkdir(parents=True, exist_ok=True)
 
-        header_excel = pathlib.Path(self.config['输出']) / 'header.xlsx'
-        self.gen_header(header_excel, progress_callback)
-        return self.gen_excel(header_excel, progress_callback)
+        progress_callback('正在生成表头..')
+        for ws in self.sheets:
+            ws_config = self.sheet_detail[ws.title]
+            if ws_config['output']:
+                # 拆分单元格
+                ws_config['merged_cells_columns'] = ws.merged_columns(ws_config['title_row2'])
+
+        # 表头写到临时目录, 同时运行的任务即使输出目录相同也不会互相覆盖
+        with tempfile.TemporaryDirectory() as tmp:
+            # 配置了列的导出只复制这些列, 使用单独的表头
+            cfg = self.config['导出']
+            header_excel = pathlib.Path(tmp) / 'header.xlsx'
+            if any(not cfg[k].get('列') for k in cfg):
+                self.gen_header(header_excel)
+
+            projections = {}
+            for k in cfg:
+                if not cfg[k].get('列'):
+                    continue
+                projection = {}
+                for ws in self.sheets:
+                    if self.sheet_detail[ws.title]['output']:
+                        projection[ws.title] = self.resolve_columns(ws, cfg[k]['列'])
+                projection_excel = pathlib.Path(tmp) / f'header_{k}.xlsx'
+                self.gen_header(projection_excel, projection)
+                projections[k] = projection_excel, projection
+            return self.gen_excel(header_excel, progress_callback, projections)
+
+    def resolve_columns(self, ws, names):
+        """把导出配置中的列(表头名称或列字母)转换为列号, 表头名称优先"""
+        ws_config = self.sheet_detail[ws.title]
+        columns = []
+        for name in names:
+            name = str(name).strip()
+            cell_rc = ws.search(name, ws_config['title_row1'], ws_config['title_row2'], TITLE_MAX_COLUMN)
+            if cell_rc:
+                columns.append(cell_rc[0])
+            elif re.match(r'^[a-zA-Z]{1,3}$', name):
+                columns.append(column_index_from_string(name.upper()))
+            else:
+                raise ValueError(f'sheet({ws.title})的表头中找不到列:{name}')
+        return columns
 
-    def gen_header(self, header_excel, progress_callback):
+    def gen_header(self, header_excel, projection=None):
+        """生成表头, projection为{sheet: [列号]}时只复制这些列, 并依次放到第1, 2, 3..列"""
         wb2 = Workbook()
         wb2.remove(wb2.active)
 
-        progress_callback('正在生成表头..')
-
-        for ws in self.wb:
+        for ws in self.sheets:
             if not self.sheet_detail[ws.title]['output']:
                 continue
             ws_config = self.sheet_detail[ws.title]
@@ -77,60 +130,79 @@ class DataHolder:
 
             title_area = f"A{ws_config['title_row1']}:BZ{ws_config['title_row2']}"
             bound = openpyxl.utils.cell.range_boundaries(title_area)
+            # 按导出后的位置复制, 同一列可以导出多次
+            if projection is None:
+                columns = range(bound[0], bound[2] + 1)
+            else:
+                columns = projection[ws.title]
+
+            # 复制单元格格式, 合并单元格的边框在合并时根据左上角设置
+            for row in range(bound[1], bound[3] + 1):
+                for dst_col, col in enumerate(columns, 1):
+                    cell = ws.cell(row, col)
+                    if cell is None or (cell.value is None and not cell.has_style):
+                        continue
+                    if projection is None and cell.value and col > ws_config['title_column2']:
+                        ws_config['title_column2'] = col
+                    copy_cell(cell, ws2.cell(row=row, column=dst_col))
 
             # 合并单元格
             area = CellRange(title_area)
             for mcr in ws.merged_cells:
                 if area.isdisjoint(mcr):
                     continue
-                cr = CellRange(mcr.coord)
-                ws2.merge_cells(cr.coord)
-
-            # 复制单元格格式
-            for row in ws[title_area]:
-                for cell in row:
-                    if cell.value and cell.column > ws_config['title_column2']:
-                        ws_config['title_column2'] = cell.column
-                    dst_cell = ws2.cell(row=cell.row, column=cell.column)
-                    copy_cell(cell, dst_cell)
+                if projection is None:
+                    ws2.merge_cells(mcr.coord)
+                    continue
+                # 只保留导出后仍然连续的合并单元格, 左上角不一定是导出的列
+                cols = [i for i, col in enumerate(columns, 1) if mcr.min_col <= col <= mcr.max_col]
+                if not cols or cols != list(range(cols[0], cols[0] + len(cols))):
+                    continue
+                copy_cell(ws.cell(mcr.min_row, mcr.min_col), ws2.cell(row=mcr.min_row, column=cols[0]))
+                cr = CellRange(min_col=cols[0], min_row=mcr.min_row, max_col=cols[-1], max_row=mcr.max_row)
+                if cr.size['columns'] * cr.size['rows'] > 1:
+                    ws2.merge_cells(cr.coord)
 
             ws2.sheet_format = copy(ws.sheet_format)
             ws2.page_margins = copy(ws.page_margins)
 
             # 设置列宽度
-            for i in range(bound[0], bound[2] + 1):
-                column_letter = openpyxl.utils.get_column_letter(i)
-                if column_letter in ws.column_dimensions:
-                    ws2.column_dimensions[column_letter].width = ws.column_dimensions[column_letter].width
+            for i, col in enumerate(columns, 1):
+                column_letter = get_column_letter(col)
+                if column_letter in ws.column_widths:
+                    ws2.column_dimensions[get_column_letter(i)].width = ws.column_widths[column_letter]
 
             # 设置行宽度
             for i in range(bound[1], bound[3] + 1):
-                if i in ws.row_dimensions:
-                    ws2.row_dimensions[i].height = ws.row_dimensions[i].height
-
-            # 拆分单元格
-            merged_cells_columns = set()
-            for mcr in ws.merged_cells:
-                mcr_bound = openpyxl.utils.cell.range_boundaries(mcr.coord)
-                if bound[3] < mcr_bound[1] < mcr_bound[3] and mcr_bound[0] == mcr_bound[2]:
-                    if mcr_bound[0] not in merged_cells_columns:
-                        merged_cells_columns.add(mcr_bound[0])
-            ws_config['merged_cells_columns'] = merged_cells_columns
+                if i in ws.row_heights:
+                    ws2.row_dimensions[i].height = ws.row_heights[i]
 
         wb2.save(header_excel)
         logger.info(f'生成表头成功:{self.sheet_detail}')
 
-    def gen_excel(self, header_excel, progress_callback):
+    def gen_excel(self, header_excel, progress_callback, projections=None):
         progress_callback('解析excel..')
         save_workbooks = []
         fp_mapping = {}
         cfg = self.config['导出']
+        projections = projections or {}
+        out_path = pathlib.Path(self.config['输出'])
         for k in cfg:
+            # 删除上次导出的分卷, 避免和这次的结果混在一起
+            for f in out_path.glob(f'{glob.escape(k)}_part*.xlsx'):
+                if re.fullmatch(rf'{re.escape(k)}_part\d+\.xlsx', f.name):
+                    f.unlink()
+                    logger.info(f'删除上次导出的分卷:{f}')
+
             map_list = cfg[k]['映射']
             out_excel = k + '.xlsx'
 
-            wb2 = openpyxl.load_workbook(header_excel, rich_text=True, data_only=True)
-            fp = {'out': out_excel, 'wb': wb2, 'row': 0, 'dirty': False}
+            excel, projection = projections.get(k, (header_excel, None))
+            wb2 = openpyxl.load_workbook(excel, rich_text=True, data_only=True)
+            fp = {'out': out_excel, 'wb': wb2, 'row': 0, 'dirty': False, 'projection': projection,
+                  'columns': None, 'name': k, 'header': excel, 'part': 1, 'rows': 0, 'size': 0,
+                  'start_row': 0, 'max_rows': cfg[k].get('最大行数', self.config.get('最大行数')),
+                  'max_size': cfg[k].get('最大大小', self.config.get('最大大小'))}
             save_workbooks.append(fp)
 
             for m in map_list:
@@ -140,13 +212,13 @@ class DataHolder:
 
         totalSheetCount = 0
         finishedSheetCount = 0
-        for ws in self.wb:
+        for ws in self.sheets:
             if self.sheet_detail[ws.title]['output']:
                 totalSheetCount += 1
 
         notClassified = set()
 
-        for ws in self.wb:
+        for ws in self.sheets:
             if not self.sheet_detail[ws.title]['output']:
                 continue
 
@@ -156,28 +228,37 @@ class DataHolder:
             ws_cfg = self.sheet_detail[ws.title]
 
             row = ws_cfg['title_row2'] + 1
-            col = ws[ws_cfg['key_cell']].column
+            col = column_index_from_string(coordinate_from_string(ws_cfg['key_cell'])[0])
+            all_columns = range(1, ws_cfg['title_column2'] + 1)
             for swb in save_workbooks:
-                swb['row'] = row
+                swb['row'] = swb['start_row'] = row
                 swb['wb'].active = swb['wb'][ws.title]
+                swb['columns'] = swb['projection'][ws.title] if swb['projection'] else all_columns
 
-            last_row = {}
+            # 纵向合并的列使用合并单元格上一行的内容
             merged_cells_columns = ws_cfg['merged_cells_columns']
+            src_rows = {}
 
             while True:
-                cell = ws.cell(row=row, column=col)
-                if type(cell) != openpyxl.cell.cell.MergedCell:
-                    if cell.value is None:
+                if ws.is_merged(row, col):
+                    s = None
+                else:
+                    s = ws.value(row, col)
+                    if s is None:
                         break
-                    if type(cell.value) == str:
-                        s = cell.value.strip()
-                        if s in fp_mapping:
-                            for swb in fp_mapping[s]:
-                                copy_line(ws, swb, row, 1, ws_cfg['title_column2'], merged_cells_columns,
-                                          last_row)
-                        elif s not in self.config['过滤']:
-                            notClassified.add(s)
-                            logger.info(f'未归类的分组: {ws.title}, {s}')
+                for c in merged_cells_columns:
+                    if not ws.is_merged(row, c):
+                        src_rows[c] = row
+                if type(s) == str:
+                    s = s.strip()
+                    if s in fp_mapping:
+                        for swb in fp_mapping[s]:
+                            if reach_limit(swb):
+                                self.rollover(swb, progress_callback)
+                            copy_line(ws, swb, row, src_rows)
+                    elif s not in self.config['过滤']:
+                        notClassified.add(s)
+                        logger.info(f'未归类的分组: {ws.title}, {s}')
                 row = row + 1
             finishedSheetCount += 1
 
@@ -186,7 +267,7 @@ class DataHolder:
         # 保存
         for swb in save_workbooks:
             progress_callback(f'生成excel {wbCount}/{wbTotal}..')
-            out_file = pathlib.Path(self.config['输出']) / swb['out']
+            out_file = pathlib.Path(self.config['输出']) / part_file(swb)
             if swb['dirty']:
                 swb['wb'].save(out_file)
                 logger.info(f'保存excel:{out_file}')
@@ -196,11 +277,23 @@ class DataHolder:
         logger.info('导出excel完成!')
         return notClassified
 
+    def rollover(self, swb, progress_callback):
+        """保存当前的excel, 后续的行写入新的分卷, 分卷重新从表头开始"""
+        out_file = pathlib.Path(self.config['输出']) / part_file(swb)
+        progress_callback(f'生成excel {out_file.name}..')
+        title = swb['wb'].active.title
+        swb['wb'].save(out_file)
+        logger.info(f"保存excel:{out_file}, {swb['rows']}行")
+
+        wb2 = openpyxl.load_workbook(swb['header'], rich_text=True, data_only=True)
+        wb2.active = wb2[title]
+        swb.update({'wb': wb2, 'row': swb['start_row'], 'dirty': False, 'part': swb['part'] + 1,
+                    'rows': 0, 'size': 0})
+
 
 def copy_cell(src_cell, dst_cell):
-    if type(src_cell) != openpyxl.cell.cell.MergedCell:
+    if type(src_cell) != openpyxl.cell.cell.MergedCell and type(dst_cell) != openpyxl.cell.cell.MergedCell:
         dst_cell.value = src_cell.value
-        dst_cell.data_type = src_cell.data_type
 
     if src_cell.has_style:
         dst_cell.font = copy(src_cell.font)
@@ -211,31 +304,34 @@ def copy_cell(src_cell, dst_cell):
         dst_cell.alignment = copy(src_cell.alignment)
 
 
-def fast_copy_font(src_cell, dst_cell):
-    src_color = src_cell.font.color
-    if src_color is None:
-        return
-    if src_color.type == 'rgb':
-        dst_cell.font = Font(color=Color(rgb=src_color.rgb))
-
-
-def copy_line(ws, swb, row, min_col, max_col, merged_cells_columns, last_row):
+def copy_line(ws, swb, row, src_rows):
     ws2 = swb['wb'].active
-    for col in range(min_col, max_col + 1):
-        src_cell = ws.cell(row=row, column=col)
-        dst_cell = ws2.cell(row=swb['row'], column=col)
-
-        if type(src_cell) == openpyxl.cell.cell.MergedCell and col in merged_cells_columns:
-            target_cell = last_row[col]
-        else:
-            target_cell = last_row[col] = src_cell
-        dst_cell.value = target_cell.value
-        dst_cell.number_format = target_cell.number_format
-        fast_copy_font(target_cell, dst_cell)
-        dst_cell.alignment = Alignment(horizontal=target_cell.alignment.horizontal,
-                                       vertical=target_cell.alignment.vertical)
-        # 很慢
-        # copy_cell(target_cell, dst_cell)
+    for dst_col, col in enumerate(swb['columns'], 1):
+        dst_cell = ws2.cell(row=swb['row'], column=dst_col)
+        ws.copy_to(src_rows.get(col, row), col, dst_cell)
+        if swb['max_size']:
+            swb['size'] += CELL_SIZE
+            if dst_cell.value is not None:
+                swb['size'] += len(str(dst_cell.value).encode('utf-8'))
 
     swb['row'] = swb['row'] + 1
+    swb['rows'] = swb['rows'] + 1
     swb['dirty'] = True
+
+
+def reach_limit(swb):
+    """写每一行之前检查, 达到限制后再写就换到下一个分卷, 所以分卷最多超出一行"""
+    if swb['row'] > EXCEL_MAX_ROW:
+        return True
+    if swb['max_rows'] and swb['rows'] >= swb['max_rows']:
+        return True
+    # 最大大小(MB)按未压缩的单元格数据估算, 不是xlsx文件的大小
+    if swb['max_size'] and swb['size'] >= swb['max_size'] * 1024 * 1024:
+        return True
+    return False
+
+
+def part_file(swb):
+    if swb['part'] == 1:
+        return swb['out']
+    return f"{swb['name']}_part{swb['part']}.xlsx"
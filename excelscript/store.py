@@ -0,0 +1,161 @@
+import logging
+from array import array
+
+from openpyxl.cell.read_only import ReadOnlyCell
+from openpyxl.styles import Font, Color, Alignment
+# openpyxl的read_only模式不提供合并单元格、列宽和行高, 这里直接使用openpyxl的私有接口:
+# worksheet._reader.WorkSheetParser, ReadOnlyWorksheet._get_source()/_shared_strings,
+# Workbook._date_formats/_timedelta_formats, 在openpyxl 3.1.5测试通过, 版本范围见requirements.txt
+from openpyxl.worksheet._reader import WorkSheetParser
+from openpyxl.worksheet.cell_range import CellRange
+from openpyxl.worksheet.dimensions import DEFAULT_COLUMN_WIDTH, SheetFormatProperties
+from openpyxl.worksheet.page import PageMargins
+
+logger = logging.getLogger(__name__)
+
+# 合并单元格(左上角以外)的样式编号, 对应openpyxl的MergedCell
+MERGED = -1
+
+
+class StyleTable:
+    """导出数据行时用到的样式, 按源workbook的样式编号缓存, 相同的样式只创建一次"""
+    __slots__ = ('ws', 'styles')
+
+    def __init__(self, ws):
+        self.ws = ws
+        self.styles = {}
+
+    def get(self, style_id):
+        style = self.styles.get(style_id)
+        if style is None:
+            cell = ReadOnlyCell(self.ws, 0, 0, None, style_id=style_id)
+            src_color = cell.font.color
+            font = None
+            if src_color is not None and src_color.type == 'rgb':
+                font = Font(color=Color(rgb=src_color.rgb))
+            alignment = Alignment(horizontal=cell.alignment.horizontal, vertical=cell.alignment.vertical)
+            style = self.styles[style_id] = font, alignment, cell.number_format
+        return style
+
+
+class SheetStore:
+    """流式读取的一个sheet, 按列保存: 每列一个值列表和一个样式编号数组(源workbook的样式编号)
+
+    读取完成后不保留openpyxl的单元格, 只有表头需要完整样式时才临时创建ReadOnlyCell
+    """
+    __slots__ = ('ws', 'title', 'values', 'style_ids', 'max_row', 'merged_cells', 'column_widths',
+                 'row_heights', 'sheet_format', 'page_margins', 'styles')
+
+    def __init__(self, ws):
+        self.ws = ws
+        self.title = ws.title
+        self.values = []
+        self.style_ids = []
+        self.max_row = 0
+        self.merged_cells = []
+        self.column_widths = {}
+        self.row_heights = {}
+        self.sheet_format = SheetFormatProperties()
+        self.page_margins = PageMargins()
+        self.styles = StyleTable(ws)
+
+    @property
+    def max_column(self):
+        return len(self.values)
+
+    @staticmethod
+    def load(ws):
+        """ws为read_only模式的worksheet, 合并单元格、列宽和行高在同一次解析中读取"""
+        store = SheetStore(ws)
+        wb = ws.parent
+        with ws._get_source() as src:
+            parser = WorkSheetParser(src, ws._shared_strings, data_only=wb.data_only, epoch=wb.epoch,
+                                     date_formats=wb._date_formats, timedelta_formats=wb._timedelta_formats,
+                                     rich_text=True)
+            for row, cells in parser.parse():
+                store.ensure(row, 0)
+                for cell in cells:
+                    store.ensure(row, cell['column'])
+                    i = cell['column'] - 1
+                    store.values[i][row - 1] = cell['value']
+                    store.style_ids[i][row - 1] = cell['style_id']
+
+        if parser.merged_cells:
+            for mc in parser.merged_cells.mergeCell:
+                cr = CellRange(mc.ref)
+                store.merged_cells.append(cr)
+                store.ensure(cr.max_row, cr.max_col)
+                for row, col in cr.cells:
+                    if (row, col) != (cr.min_row, cr.min_col):
+                        store.values[col - 1][row - 1] = None
+                        store.style_ids[col - 1][row - 1] = MERGED
+        for letter, cd in parser.column_dimensions.items():
+            store.column_widths[letter] = float(cd.get('width', DEFAULT_COLUMN_WIDTH))
+        for row, rd in parser.row_dimensions.items():
+            store.row_heights[int(row)] = float(rd['ht']) if 'ht' in rd else None
+        if getattr(parser, 'sheet_format', None) is not None:
+            store.sheet_format = parser.sheet_format
+        if getattr(parser, 'page_margins', None) is not None:
+            store.page_margins = parser.page_margins
+        logger.debug(f'sheet({store.title})读取{store.max_row}行{store.max_column}列')
+        return store
+
+    def ensure(self, max_row, max_col):
+        """扩展到max_row行, max_col列, 新的单元格为空"""
+        if max_row > self.max_row:
+            n = max_row - self.max_row
+            for i in range(len(self.values)):
+                self.values[i].extend([None] * n)
+                self.style_ids[i].frombytes(bytes(self.style_ids[i].itemsize * n))
+            self.max_row = max_row
+        while len(self.values) < max_col:
+            self.values.append([None] * self.max_row)
+            self.style_ids.append(array('i', bytes(array('i').itemsize * self.max_row)))
+
+    def value(self, row, col):
+        if row > self.max_row or col > len(self.values):
+            return None
+        return self.values[col - 1][row - 1]
+
+    def style_id(self, row, col):
+        if row > self.max_row or col > len(self.values):
+            return 0
+        return self.style_ids[col - 1][row - 1]
+
+    def is_merged(self, row, col):
+        return self.style_id(row, col) == MERGED
+
+    def cell(self, row, col):
+        """带完整样式的单元格, 合并单元格返回None"""
+        style_id = self.style_id(row, col)
+        if style_id == MERGED:
+            return None
+        return ReadOnlyCell(self.ws, row, col, self.value(row, col), style_id=style_id)
+
+    def search(self, keyword, min_row, max_row, max_col):
+        """按文本查找单元格, 数字和富文本也按显示的文本比较"""
+        keyword = str(keyword).strip()
+        for row in range(min_row, min(max_row, self.max_row) + 1):
+            for col in range(1, min(max_col, len(self.values)) + 1):
+                value = self.values[col - 1][row - 1]
+                if value is not None and keyword == str(value).strip():
+                    return col, row
+
+    def merged_columns(self, title_row2):
+        """表头以下纵向合并的列"""
+        merged_cells_columns = set()
+        for mcr in self.merged_cells:
+            if title_row2 < mcr.min_row < mcr.max_row and mcr.min_col == mcr.max_col:
+                merged_cells_columns.add(mcr.min_col)
+        return merged_cells_columns
+
+    def copy_to(self, row, col, dst_cell):
+        """复制值、数字格式、字体颜色和对齐方式, copy_cell很慢"""
+        style_id = self.style_id(row, col)
+        font, alignment, number_format = self.styles.get(0 if style_id == MERGED else style_id)
+        dst_cell.value = self.value(row, col)
+        dst_cell.number_format = number_format
+        if font is not None:
+            dst_cell.font = font
+        dst_cell.alignment = alignment
+
@@ -3,6 +3,7 @@ import pathlib
 import re
 import sys
 import traceback
+import urllib.error
 
 from PyQt6.QtCore import Qt, pyqtSignal, QObject, QTimer, QThread
 from PyQt6.QtGui import QFont, QIcon
@@ -10,6 +11,7 @@ from PyQt6.QtWidgets import QMainWindow, QApplication, QLabel, QMessageBox, QWid
     QHBoxLayout, QVBoxLayout, QListWidget, QListWidgetItem, QLineEdit, QPushButton, QDialog, QCheckBox
 from openpyxl.utils import exceptions
 
+from . import daemon
 from .data import DataHolder
 
 logger = logging.getLogger(__name__)
@@ -140,8 +142,20 @@ class MainWindow(QMainWindow):
         self.long_time_task(fn)
 
     def outputExcel(self):
+        dataHolder = self.mainWidget.dataHolder
+
         def fn(progress_callback):
-            return self.mainWidget.dataHolder.gen(progress_callback)
+            if '服务' in dataHolder.config:
+                sheets = {}
+                for title, detail in dataHolder.sheet_detail.items():
+                    sheets[title] = {k: detail[k] for k in daemon.SHEET_KEYS}
+                try:
+                    return daemon.submit(dataHolder.config, dataHolder.file, sheets,
+                                         progress_callback=progress_callback)
+                except urllib.error.URLError as e:
+                    # 只有连接不上服务时才本地导出, 任务提交后的错误是RuntimeError, 不会重复导出
+                    logger.info(f'拆表服务不可用, 本地导出:{e}')
+            return dataHolder.gen(progress_callback)
 
         self.long_time_task(fn)
 
@@ -383,8 +397,7 @@ class MainWidget(QWidget):
 
     def setDataHolder(self, dataHolder):
         self.dataHolder = dataHolder
-        wb = dataHolder.wb
-        sheets = [ws.title for ws in wb]
+        sheets = [ws.title for ws in dataHolder.sheets]
         logger.info(f'设置DataHolder:{sheets}')
         for sheet in sheets:
             item = QListWidgetItem()
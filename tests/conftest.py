@@ -0,0 +1,41 @@
+import openpyxl
+from openpyxl.cell.rich_text import CellRichText, TextBlock
+from openpyxl.cell.text import InlineFont
+from openpyxl.styles import Font, Color, Border, Side
+
+ANIMALS = ['虎', '狗', '虎', '熊猫', '虎', '合计', '狗']
+
+
+def make_source(path):
+    wb = openpyxl.Workbook()
+    ws = wb.active
+    ws.title = 'S1'
+    thin = Side(style='thin')
+    ws['A1'] = '标题'
+    ws['A1'].border = Border(top=thin, left=thin, right=thin, bottom=thin)
+    ws.merge_cells('A1:D1')
+    for i, h in enumerate(['序号', '动物', '名称', '数量', 2023], 1):
+        ws.cell(row=2, column=i, value=h)
+    ws['C2'] = CellRichText(['名', TextBlock(InlineFont(b=True), '称')])
+    ws.column_dimensions['C'].width = 30
+    for i, animal in enumerate(ANIMALS):
+        row = i + 3
+        ws.cell(row=row, column=1, value=i)
+        ws.cell(row=row, column=2, value=animal)
+        ws.cell(row=row, column=3, value=f'n{i}').font = Font(color=Color(rgb='FFFF0000'))
+        ws.cell(row=row, column=4, value=i * 1.5).number_format = '0.00'
+        ws.cell(row=row, column=5, value=i * 2)
+    ws.merge_cells('A4:A6')
+    wb.save(path)
+    return path
+
+
+def make_config(tmp_path, **config):
+    cfg = {
+        '分组': '动物',
+        '输出': str(tmp_path / 'output'),
+        '导出': {'out_猫科': {'映射': ['虎']}, 'out_犬科': {'映射': ['狗']}},
+        '过滤': ['合计'],
+    }
+    cfg.update(config)
+    return cfg
@@ -0,0 +1,118 @@
+import os
+import threading
+import urllib.error
+import urllib.request
+
+import openpyxl
+import pytest
+from conftest import make_config, make_source
+
+from excelscript import daemon
+
+
+def wait(job):
+    return list(job.follow())[-1]
+
+
+def test_cache_eviction(tmp_path):
+    a = make_source(tmp_path / 'a.xlsx')
+    b = make_source(tmp_path / 'b.xlsx')
+    cache = daemon.WorkbookCache(1)
+
+    entry = cache.get(a)
+    entry['sheets'] = 'a'
+    assert cache.get(a) is entry
+
+    cache.get(b)
+    assert len(cache.entries) == 1
+    assert cache.get(a)['sheets'] is None
+
+    # 文件修改后重新读取
+    entry = cache.get(a)
+    entry['sheets'] = 'a'
+    os.utime(a, ns=(0, 0))
+    assert cache.get(a) is not entry
+    assert len(cache.entries) == 1
+
+
+def test_jobs(tmp_path, monkeypatch):
+    monkeypatch.setattr(daemon, 'read_config', lambda: make_config(tmp_path))
+    split = daemon.SplitDaemon(workers=2, cache=2)
+    a = make_source(tmp_path / 'a.xlsx')
+    b = make_source(tmp_path / 'b.xlsx')
+
+    # 不同文件、相同输出目录的任务同时运行
+    jobs = [split.submit(str(a), {}), split.submit(str(b), {}, {'导出': {'out_a': {'映射': ['虎'], '列': ['B']}}})]
+    results = [wait(job) for job in jobs]
+    assert [set(r['result']) for r in results] == [{'熊猫'}, {'狗', '熊猫'}]
+    ws = openpyxl.load_workbook(tmp_path / 'output' / 'out_a.xlsx')['S1']
+    assert [c.value for c in ws['A']] == ['标题', '动物', '虎', '虎', '虎']
+
+    sheets = split.cache.get(a)['sheets']
+    job = split.submit(str(a), {'S1': {'output': True, 'title_row2': 2}})
+    assert wait(job)['type'] == 'result'
+    assert split.cache.get(a)['sheets'] is sheets
+    assert {'type': 'progress', 'msg': '读取excel..'} not in job.events
+
+    assert wait(split.submit(str(a), {'S2': {'output': True}})) == {'type': 'error', 'msg': "'sheet不存在:S2'"}
+
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    monkeypatch.setattr(daemon, 'read_config', lambda: make_config(tmp_path))
+    config = {'服务': {'端口': 0, '线程': 1, '令牌': 'secret'}}
+    server = daemon.make_server(config)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    config['服务']['端口'] = server.server_address[1]
+    yield config
+    server.shutdown()
+    server.server_close()
+
+
+def test_submit(tmp_path, server, monkeypatch):
+    # 本机的服务不经过代理
+    for key in ('no_proxy', 'NO_PROXY'):
+        monkeypatch.delenv(key, raising=False)
+    monkeypatch.setenv('http_proxy', 'http://127.0.0.1:9')
+    source = make_source(tmp_path / 'source.xlsx')
+    progress = []
+    assert daemon.submit(server, source, progress_callback=progress.append) == {'熊猫'}
+    assert progress[0].startswith('排队中')
+    assert (tmp_path / 'output' / 'out_猫科.xlsx').exists()
+    assert not (tmp_path / 'output' / 'header.xlsx').exists()
+
+
+def test_submit_rejected(tmp_path, server):
+    source = make_source(tmp_path / 'source.xlsx')
+    with pytest.raises(RuntimeError, match='不允许修改输出目录'):
+        daemon.submit(server, source, job_config={'输出': str(tmp_path / 'elsewhere')})
+
+    for name in ['../victim', str(tmp_path / 'victim'), 'a\\..\\victim', 'C:victim']:
+        with pytest.raises(RuntimeError, match='导出名称不合法'):
+            daemon.submit(server, source, job_config={'导出': {name: {'映射': ['虎']}}})
+    assert not (tmp_path / 'victim.xlsx').exists()
+
+    with pytest.raises(RuntimeError, match='令牌错误'):
+        daemon.submit({'服务': dict(server['服务'], 令牌='wrong')}, source)
+
+    # 没有令牌不能查询任务是否存在
+    url = f"http://127.0.0.1:{server['服务']['端口']}/jobs"
+    with pytest.raises(urllib.error.HTTPError) as e:
+        urllib.request.urlopen(f'{url}/1')
+    assert e.value.code == 403
+
+    # 网页可以不经过预检发送的text/plain请求
+    req = urllib.request.Request(url, data=b'{}', headers={'Content-Type': 'text/plain', 'X-Token': 'secret'})
+    with pytest.raises(urllib.error.HTTPError) as e:
+        urllib.request.urlopen(req)
+    assert e.value.code == 415
+
+
+def test_submit_stream_error(tmp_path, server, monkeypatch):
+    # 任务已经提交, 查询失败不能当作服务不可用
+    def do_GET(self):
+        self.send_json(500, {'msg': '服务错误'})
+
+    monkeypatch.setattr(daemon.RequestHandler, 'do_GET', do_GET)
+    with pytest.raises(RuntimeError, match='服务错误'):
+        daemon.submit(server, make_source(tmp_path / 'source.xlsx'))
@@ -0,0 +1,125 @@
+import openpyxl
+import pytest
+from conftest import make_config, make_source
+
+from excelscript.data import DataHolder, load_sheets
+
+
+def make_holder(tmp_path, **config):
+    file = make_source(tmp_path / 'source.xlsx')
+    holder = DataHolder(file, load_sheets(file), make_config(tmp_path, **config))
+    holder.sheet_detail['S1']['output'] = True
+    return holder
+
+
+def read_rows(path):
+    ws = openpyxl.load_workbook(path)['S1']
+    return [[c.value for c in row] for row in ws.iter_rows()]
+
+
+def test_load_sheets(tmp_path):
+    ws, = load_sheets(make_source(tmp_path / 'source.xlsx'))
+    assert ws.title == 'S1'
+    assert ws.max_row == 9
+    assert ws.max_column == 5
+    assert ws.value(3, 2) == '虎'
+    assert ws.is_merged(5, 1) and ws.is_merged(1, 2)
+    assert not ws.is_merged(4, 1)
+    assert ws.column_widths['C'] == 30
+    assert ws.cell(3, 4).number_format == '0.00'
+    assert ws.merged_columns(2) == {1}
+
+
+def test_key_cell(tmp_path):
+    holder = make_holder(tmp_path)
+    assert holder.sheet_detail['S1']['key_cell'] == 'B2'
+    assert holder.sheet_detail['S1']['title_row2'] == 2
+
+
+def test_gen(tmp_path):
+    holder = make_holder(tmp_path)
+    assert holder.gen(lambda msg: None) == {'熊猫'}
+
+    out = tmp_path / 'output' / 'out_猫科.xlsx'
+    assert read_rows(out) == [
+        ['标题', None, None, None, None],
+        ['序号', '动物', '名称', '数量', 2023],
+        [0, '虎', 'n0', 0, 0],
+        # A4:A6纵向合并, 使用合并单元格的内容
+        [1, '虎', 'n2', 3, 4],
+        [4, '虎', 'n4', 6, 8],
+    ]
+    ws = openpyxl.load_workbook(out)['S1']
+    assert [str(r) for r in ws.merged_cells.ranges] == ['A1:D1']
+    assert ws['D1'].border.right.style == 'thin'
+    assert ws['C3'].font.color.rgb == 'FFFF0000'
+    assert ws['D4'].number_format == '0.00'
+    assert ws.column_dimensions['C'].width == 30
+
+    assert read_rows(tmp_path / 'output' / 'out_犬科.xlsx')[2:] == [[1, '狗', 'n1', 1.5, 2], [6, '狗', 'n6', 9, 12]]
+
+
+def test_projection(tmp_path):
+    holder = make_holder(tmp_path, 导出={'out_a': {'映射': ['虎'], '列': ['名称', 'a', '名称', 2023]},
+                                        'out_b': {'映射': ['狗'], '列': ['B']}})
+    progress = []
+    holder.gen(progress.append)
+    assert progress.count('正在生成表头..') == 1
+    assert read_rows(tmp_path / 'output' / 'out_b.xlsx') == [['标题'], ['动物'], ['狗'], ['狗']]
+
+    out = tmp_path / 'output' / 'out_a.xlsx'
+    assert read_rows(out) == [
+        ['标题', None, None, None],
+        ['名称', '序号', '名称', 2023],
+        ['n0', 0, 'n0', 0],
+        ['n2', 1, 'n2', 4],
+        ['n4', 4, 'n4', 8],
+    ]
+    ws = openpyxl.load_workbook(out)['S1']
+    # A1:D1中导出的列是C, A, C, 合并到A1:C1
+    assert [str(r) for r in ws.merged_cells.ranges] == ['A1:C1']
+    assert ws['C1'].border.right.style == 'thin'
+    assert ws.column_dimensions['A'].width == ws.column_dimensions['C'].width == 30
+    assert ws['A3'].font.color.rgb == 'FFFF0000'
+    assert not (tmp_path / 'output' / 'header.xlsx').exists()
+
+
+def test_projection_unknown_column(tmp_path):
+    holder = make_holder(tmp_path, 导出={'out_a': {'映射': ['虎'], '列': ['价格']}})
+    with pytest.raises(ValueError, match='找不到列:价格'):
+        holder.gen(lambda msg: None)
+
+
+def test_load_missing_file(tmp_path):
+    with pytest.raises(FileNotFoundError):
+        load_sheets(tmp_path / 'missing.xlsx')
+
+
+def test_rollover(tmp_path):
+    holder = make_holder(tmp_path, 最大行数=2, 导出={'out_猫科': {'映射': ['虎']},
+                                                 'out_犬科': {'映射': ['狗'], '最大行数': 0}})
+    output = tmp_path / 'output'
+    output.mkdir()
+    (output / 'out_猫科_part5.xlsx').touch()
+    (output / 'out_猫科_part_备注.xlsx').touch()
+    holder.gen(lambda msg: None)
+
+    assert sorted(f.name for f in output.iterdir()) == [
+        'out_犬科.xlsx', 'out_猫科.xlsx', 'out_猫科_part2.xlsx', 'out_猫科_part_备注.xlsx']
+    header = [['标题', None, None, None, None], ['序号', '动物', '名称', '数量', 2023]]
+    assert read_rows(output / 'out_猫科.xlsx') == header + [[0, '虎', 'n0', 0, 0], [1, '虎', 'n2', 3, 4]]
+    assert read_rows(output / 'out_猫科_part2.xlsx') == header + [[4, '虎', 'n4', 6, 8]]
+    ws = openpyxl.load_workbook(output / 'out_猫科_part2.xlsx')['S1']
+    assert [str(r) for r in ws.merged_cells.ranges] == ['A1:D1']
+    assert len(read_rows(output / 'out_犬科.xlsx')) == 4
+
+
+def test_rollover_size(tmp_path):
+    # 每行5个单元格, 估算超过100字节
+    holder = make_holder(tmp_path, 最大大小=100 / 1024 / 1024, 导出={'out_猫科': {'映射': ['虎']}})
+    holder.gen(lambda msg: None)
+
+    output = tmp_path / 'output'
+    assert sorted(f.name for f in output.iterdir()) == [
+        'out_猫科.xlsx', 'out_猫科_part2.xlsx', 'out_猫科_part3.xlsx']
+    assert read_rows(output / 'out_猫科_part3.xlsx')[2:] == [[4, '虎', 'n4', 6, 8]]